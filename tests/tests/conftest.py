@@ -1,11 +1,11 @@
 import pytest
-from lib import TestConfig, clear_keys, clear_local_config, run_delete_kvstore_command
+from lib import TestConfig, clear_local_state, flush_agent, run_delete_kvstore_commands
 
 
 @pytest.fixture(autouse=True)
 def run_around_tests():
-    clear_keys()
-    clear_local_config()
+    clear_local_state()
+    flush_agent()
     # Calling yield triggers the test execution
     yield
 
@@ -14,8 +14,12 @@ def pytest_sessionfinish(session, exitstatus):
     # Automatically run after all tests in order to ensure that no kssh-client
     # configs stick around
     tc = TestConfig.getDefaultTestConfig()
-    run_delete_kvstore_command(f"{tc.subteam}.ssh")
-    run_delete_kvstore_command(f"{tc.subteam}.ssh.staging")
-    run_delete_kvstore_command(f"{tc.subteam}.ssh.prod")
-    run_delete_kvstore_command(f"{tc.subteam}.ssh.root_everywhere")
-    run_delete_kvstore_command(tc.subteam_secondary)
+    run_delete_kvstore_commands(
+        [
+            f"{tc.subteam}.ssh",
+            f"{tc.subteam}.ssh.staging",
+            f"{tc.subteam}.ssh.prod",
+            f"{tc.subteam}.ssh.root_everywhere",
+            tc.subteam_secondary,
+        ]
+    )
@@ -1,14 +1,28 @@
+import functools
+import glob
 import hashlib
 import json
 import os
+import re
+import select
 import signal
 import subprocess
+import threading
 import time
 from contextlib import contextmanager
-from typing import List, Set
+from typing import Dict, List, Optional, Set, Union
 
 import requests
 
+# Cache of the last-seen audit log size in bytes keyed by filename. The audit
+# log is append-only, so outputs_audit_log can use the cached size as its
+# "before" snapshot: each test only pays for one `keybase fs read` (after the
+# body runs) and only the appended suffix gets scanned, rather than
+# splitting and set-diffing the whole growing file. Guarded by a lock so this
+# stays correct if the tests are ever run in parallel.
+_audit_log_lock = threading.Lock()
+_last_audit_sizes: Dict[str, int] = {}
+
 
 def getDefaultExpectedHash() -> bytes:
     # "uniquestring" is stored in /etc/unique of the SSH server. We then run
@@ -34,23 +48,132 @@ class TestConfig:
         self.subteam: str = subteam
         self.subteam_secondary: str = subteam_secondary
         self.username: str = username
+        # The username as bytes, encoded once here so assertions against
+        # command output don't re-encode it
+        self.username_bytes: bytes = username.encode("utf-8")
         self.bot_username: str = bot_username
         self.expected_hash: bytes = expected_hash
         self.subteams: List[str] = subteams
 
+    # The default config built from the environment, created once since the
+    # environment variables never change while the tests are running
+    _defaultTestConfig = None
+
     @staticmethod
     def getDefaultTestConfig():
-        return TestConfig(
-            os.environ["SUBTEAM"],
-            os.environ["SUBTEAM_SECONDARY"],
-            os.environ["KSSH_USERNAME"],
-            os.environ["BOT_USERNAME"],
-            getDefaultExpectedHash(),
-            [
-                os.environ["SUBTEAM"] + postfix
-                for postfix in [".ssh.prod", ".ssh.staging", ".ssh.root_everywhere"]
-            ],
-        )
+        if TestConfig._defaultTestConfig is None:
+            TestConfig._defaultTestConfig = TestConfig(
+                os.environ["SUBTEAM"],
+                os.environ["SUBTEAM_SECONDARY"],
+                os.environ["KSSH_USERNAME"],
+                os.environ["BOT_USERNAME"],
+                getDefaultExpectedHash(),
+                [
+                    os.environ["SUBTEAM"] + postfix
+                    for postfix in [".ssh.prod", ".ssh.staging", ".ssh.root_everywhere"]
+                ],
+            )
+        return TestConfig._defaultTestConfig
+
+
+class KvStoreClient:
+    """
+    A persistent `keybase kvstore api` process. The api command reads a
+    stream of JSON messages from stdin and writes one JSON response per
+    message to stdout, so every kvstore call can share a single keybase
+    process instead of forking a fresh one per call. The process is started
+    lazily on the first call and restarted if it dies.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._process: Optional[subprocess.Popen] = None
+
+    def _ensure_process(self) -> subprocess.Popen:
+        if self._process is None or self._process.poll() is not None:
+            # bufsize=0 so that stdout reads only return what the process
+            # has actually written, which lets _read_response enforce its
+            # timeout with select
+            self._process = subprocess.Popen(
+                ["keybase", "kvstore", "api"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                bufsize=0,
+            )
+        return self._process
+
+    @staticmethod
+    def _read_response(process: subprocess.Popen, timeout: int) -> bytes:
+        # Read one response line from the process with a timeout so a wedged
+        # keybase process fails the calling test rather than hanging the
+        # whole suite on the blocked readline
+        deadline = time.time() + timeout
+        response = b""
+        while not response.endswith(b"\n"):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                process.kill()
+                raise subprocess.TimeoutExpired(
+                    "keybase kvstore api", timeout, response
+                )
+            ready, _, _ = select.select([process.stdout], [], [], remaining)
+            if not ready:
+                continue
+            chunk = process.stdout.read(4096)
+            if not chunk:
+                # EOF: the process died mid-call
+                break
+            response += chunk
+        return response
+
+    def call(self, method: str, options: Dict[str, str], timeout: int = 15) -> bytes:
+        """
+        Send one kvstore API message and return the response line, raising
+        CalledProcessError if keybase reports an error for the call
+        :param method:      The kvstore API method (get/put/del)
+        :param options:     The options dict for the API call
+        :param timeout:     The timeout in seconds for the response
+        :return:            The JSON response from keybase
+        """
+        msg = json.dumps({"method": method, "params": {"options": options}})
+        with self._lock:
+            process = self._ensure_process()
+            process.stdin.write(msg.encode("utf-8") + b"\n")
+            process.stdin.flush()
+            response = self._read_response(process, timeout)
+        if not response:
+            # The process died mid-call; surface it the same way run_command
+            # surfaces a failed command
+            returncode = process.wait()
+            raise subprocess.CalledProcessError(
+                returncode or -1, "keybase kvstore api", response, None
+            )
+        # The persistent process stays alive across failed calls, so errors
+        # show up in the response body rather than the exit code. Surface
+        # them the same way the one-shot form did.
+        try:
+            error = json.loads(response).get("error")
+        except ValueError:
+            error = response
+        if error:
+            raise subprocess.CalledProcessError(
+                1, "keybase kvstore api", response, None
+            )
+        return response
+
+
+_kvstore_client = KvStoreClient()
+
+
+def run_kvstore_command(method: str, options: Dict[str, str]) -> bytes:
+    """
+    Run a "keybase kvstore api" command with the given method and options
+    over the shared persistent keybase process
+    :param method:      The kvstore API method (get/put/del)
+    :param options:     The options dict for the API call
+    :return:            The JSON response from keybase
+    """
+    return _kvstore_client.call(method, options)
 
 
 def run_put_kvstore_command(team: str, config: str) -> bytes:
@@ -60,13 +183,14 @@ def run_put_kvstore_command(team: str, config: str) -> bytes:
     :param team:    The team to write the config for
     :return:        The stdout of the process
     """
-    # the extra json.dumps is to add the expected quotation marks
-    return run_command(
-        f'echo \'{{"method":"put", "params": {{'
-        f'"options": {{"team": "{team}", '
-        f'"namespace": "__sshca", "entryKey": "kssh_config",'
-        f'"entryValue": {json.dumps(config)} }}}}}}\' | '
-        f"xargs -0 -I put keybase kvstore api -m put"
+    return run_kvstore_command(
+        "put",
+        {
+            "team": team,
+            "namespace": "__sshca",
+            "entryKey": "kssh_config",
+            "entryValue": config,
+        },
     )
 
 
@@ -77,29 +201,88 @@ def run_delete_kvstore_command(team: str) -> bytes:
     :param team:    The team to delete the config from
     :return:        The stdout of the process
     """
-    return run_command(
-        f'echo \'{{"method": "del", '
-        f'"params": {{"options": {{"team": '
-        f'"{team}", "namespace": "__sshca", '
-        f'"entryKey": "kssh_config"}}}}}}\' | '
-        f"xargs -0 -I del keybase kvstore api -m del || true"
-    )
+    try:
+        return run_kvstore_command(
+            "del",
+            {"team": team, "namespace": "__sshca", "entryKey": "kssh_config"},
+        )
+    except subprocess.CalledProcessError as e:
+        # Deleting a config that doesn't exist is fine
+        return e.output
+    except OSError:
+        # These deletes are best-effort cleanup (the old shell form ended in
+        # `|| true`), so a keybase process that can't even start shouldn't
+        # fail the run either
+        return b""
+
+
+def run_delete_kvstore_commands(teams: List[str]) -> bytes:
+    """
+    Delete the kssh_config from each of the given teams over the shared
+    persistent keybase process
+    :param teams:   The teams to delete the config from
+    :return:        The JSON responses from keybase
+    """
+    return b"".join(run_delete_kvstore_command(team) for team in teams)
+
+
+# The shared ssh-agent used by run_command_with_agent. The old behavior of
+# running `eval `ssh-agent`` per command forked (and leaked) a fresh agent
+# for every invocation; instead one agent is started lazily and its socket
+# is handed to each command through the environment. flush_agent drops its
+# identities between tests so every test still sees a clean agent.
+_agent_lock = threading.Lock()
+_agent_env: Optional[Dict[str, str]] = None
+
+
+def _get_agent_env() -> Dict[str, str]:
+    global _agent_env
+    with _agent_lock:
+        if _agent_env is None:
+            output = subprocess.check_output(["ssh-agent", "-s"]).decode("utf-8")
+            env = dict(os.environ)
+            for match in re.finditer(r"(SSH_AUTH_SOCK|SSH_AGENT_PID)=([^;]+);", output):
+                env[match.group(1)] = match.group(2)
+            _agent_env = env
+        return _agent_env
+
+
+def flush_agent():
+    # Remove all identities from the shared ssh-agent so that the next test
+    # starts with a clean agent. A no-op if no test has used the agent yet.
+    if _agent_env is None:
+        return
+    try:
+        run_command(["ssh-add", "-D"], env=_agent_env)
+    except subprocess.CalledProcessError:
+        pass
 
 
 def run_command_with_agent(cmd: str) -> bytes:
     """
-    Run the given command in a shell session with a running ssh-agent
+    Run the given command in a shell session with access to the shared
+    ssh-agent
     :param cmd:     The command to run
     :return:        The stdout of the process
     """
-    return run_command("eval `ssh-agent` && " + cmd)
+    return run_command(cmd, env=_get_agent_env())
 
 
-def run_command(cmd: str, timeout: int = 15) -> bytes:
+def run_command(
+    cmd: Union[str, List[str]],
+    timeout: int = 15,
+    input: Optional[bytes] = None,
+    env: Optional[Dict[str, str]] = None,
+) -> bytes:
     """
-    Run the given command in a shell with the given timeout
+    Run the given command with the given timeout. A string is run through a
+    shell; a list of arguments is executed directly, which skips the extra
+    /bin/sh fork per invocation and should be preferred for commands that
+    don't need shell features (pipes, globs, env sharing).
     :param cmd:         The command to run
     :param timeout:     The timeout in seconds
+    :param input:       Bytes to send to the process over stdin
+    :param env:         The environment for the process, defaulting to ours
     :return:            The stdout of the process
     """
     # In order to properly run a command with a timeout and shell=True, we use
@@ -109,10 +292,17 @@ def run_command(cmd: str, timeout: int = 15) -> bytes:
     # - https://stackoverflow.com/questions/4789837/how-to-terminate-a-
     #       python-subprocess-launched-with-shell-true
     with subprocess.Popen(
-        cmd, shell=True, stdout=subprocess.PIPE, preexec_fn=os.setsid
+        cmd,
+        shell=isinstance(cmd, str),
+        stdin=subprocess.PIPE if input is not None else None,
+        stdout=subprocess.PIPE,
+        env=env,
+        # start_new_session gives the same setsid behavior as a preexec_fn
+        # but is safe to use from multiple threads
+        start_new_session=True,
     ) as process:
         try:
-            stdout, stderr = process.communicate(timeout=timeout)
+            stdout, stderr = process.communicate(input=input, timeout=timeout)
             if process.returncode != 0:
                 print(f"Output before return: {repr(stdout)}, {repr(stderr)}")
                 raise subprocess.CalledProcessError(
@@ -125,64 +315,101 @@ def run_command(cmd: str, timeout: int = 15) -> bytes:
             raise e
 
 
-def read_file(filename: str) -> List[bytes]:
+def _file_size(filename: str) -> Optional[int]:
+    """
+    Return the size of the given file via a stat when possible. KBFS paths
+    can't be stat'ed without fuse running in the container, so those return
+    None and the caller has to read the contents to learn the size.
+    :param filename:    The name of the file to stat
+    :return:            The size in bytes, or None for KBFS paths
     """
-    Read the contents of the given filename to a list of strings. If it is a
-    normal file, uses the standard open() function. Otherwise, uses `keybase fs
-    read`. This is because fuse is not running in the container so a normal
-    open call will not work for KBFS.
+    if filename.startswith("/keybase/"):
+        return None
+    try:
+        return os.path.getsize(filename)
+    except FileNotFoundError:
+        return 0
+
+
+def read_file_bytes(filename: str) -> bytes:
+    """
+    Read the raw contents of the given filename. KBFS paths go through
+    `keybase fs read` since fuse is not running in the container, so a
+    normal open call will not work for them.
     :param filename:    The name of the file to read
-    :return:            A list of lines in the file
+    :return:            The contents of the file
     """
     if filename.startswith("/keybase/"):
-        return run_command(f"keybase fs read {filename}").splitlines()
+        return run_command(f"keybase fs read {filename}")
     with open(filename, "rb") as f:
-        return f.readlines()
+        return f.read()
 
 
 def clear_keys():
     # Clear all keys generated by kssh
-    try:
-        run_command("rm -rf ~/.ssh/keybase-signed-key*")
-    except subprocess.CalledProcessError:
-        pass
+    for path in glob.glob(os.path.expanduser("~/.ssh/keybase-signed-key*")):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
 
 
-def clear_local_config():
-    # Clear kssh's local config file
+def clear_local_state():
+    # Clear all local kssh state (generated keys plus the local config file)
+    # with a single sweep of ~/.ssh rather than one directory scan per
+    # pattern. Runs before every test via the run_around_tests fixture.
     try:
-        run_command("rm -rf ~/.ssh/kssh-config.json")
-    except subprocess.CalledProcessError:
-        pass
+        entries = os.scandir(os.path.expanduser("~/.ssh"))
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            if (
+                entry.name.startswith("keybase-signed-key")
+                or entry.name == "kssh-config.json"
+            ):
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
 
 
 def load_env(filename: str):
     # Load the environment based off of the given filename which is the path to
     # the python test script
     env_name = os.path.basename(filename).split(".")[0]
-    return (
+    ok = (
         requests.get(f"http://ca-bot:8080/load_env?filename={env_name}").content
         == b"OK"
     )
+    if ok:
+        # Loading an environment wipes the CA logs, and a wiped log can grow
+        # back past a stale cached offset (different environments share
+        # /shared/ca.log), so force a fresh full read on the next use
+        with _audit_log_lock:
+            _last_audit_sizes.clear()
+    return ok
 
 
 def assert_contains_hash(expected_hash: bytes, output: bytes):
-    assert expected_hash in output
+    # Both sides stay as bytes; repr handles any non-utf8 output in the
+    # failure message
+    assert expected_hash in output, f"{expected_hash!r} not found in {output!r}"
 
 
 @contextmanager
 def simulate_two_teams(tc: TestConfig):
     # A context manager that simulates running the given function in an
-    # environment with two teams set up
-    get_res = run_command(
-        f'echo \'{{"method": "get", "params": {{"options": {{"team": '
-        f'"{tc.subteam}.ssh.staging", "namespace": "__sshca", '
-        f'"entryKey": "kssh_config"}}}}}}\' | '
-        f"xargs -0 -I get keybase kvstore api -m get"
-    )
-    config = json.loads(json.loads(get_res)["result"]["entryValue"])
-    config["teamname"] = tc.subteam_secondary
-    config["botname"] = "otherbotname"
+    # environment with two teams set up. The secondary team's config is
+    # built in-process rather than fetched from kvstore and mutated: it
+    # mirrors what the bot writes under test_env_1 (see writeClientConfig in
+    # bot.go) with the team and bot names swapped out, which skips a kvstore
+    # round-trip per use
+    config = {
+        "teamname": tc.subteam_secondary,
+        "channelname": "ssh-provision",
+        "botname": "otherbotname",
+    }
     run_put_kvstore_command(tc.subteam_secondary, json.dumps(config))
     try:
         yield
@@ -190,45 +417,90 @@ def simulate_two_teams(tc: TestConfig):
         run_delete_kvstore_command(tc.subteam_secondary)
 
 
+@functools.lru_cache(maxsize=None)
+def _audit_log_matcher(username: str, subteam: str):
+    # Compile the matcher for the audit log lines the tests trigger once per
+    # (username, subteam) pair rather than rebuilding the expected substrings
+    # for every line of every poll. The log format (sshutils.go) always puts
+    # user= before principals:
+    return re.compile(
+        re.escape(f"Processing SignatureRequest from user={username}".encode("utf-8"))
+        + b".*"
+        + re.escape(
+            (
+                f"principals:{subteam}.ssh.staging,"
+                f"{subteam}.ssh.root_everywhere, expiration:+1h, pubkey:"
+            ).encode("utf-8")
+        )
+    )
+
+
+def _count_matching_audit_lines(tc: TestConfig, lines: List[bytes]) -> int:
+    # Count how many of the given audit log lines match the signature
+    # request that the tests trigger
+    matcher = _audit_log_matcher(tc.username, tc.subteam)
+    return sum(1 for line in lines if matcher.search(line))
+
+
 @contextmanager
 def outputs_audit_log(tc: TestConfig, filename: str, expected_number: int):
     # A context manager that asserts that the given function triggers
     # expected_number of audit logs to be added to the log at the given
     # filename
 
-    # Make a set of the lines in the audit log before we ran
-    before_lines = set(read_file(filename))
+    # Record the size of the audit log before we ran, reusing the size cached
+    # by the previous invocation when we have it so that only the "after"
+    # read hits KBFS. The log is append-only so everything past this offset
+    # is new.
+    with _audit_log_lock:
+        before_size = _last_audit_sizes.get(filename)
+    if before_size is None:
+        before_size = len(read_file_bytes(filename))
 
     # Then run the code inside the context manager
     yield
 
-    # And sleep to give KBFS some time
-    time.sleep(2.5)
-
-    # Then see if there are new lines using set difference. This is only
-    # safe/reasonable since we include a timestamp in audit log lines.
-    after_lines = set(read_file(filename))
-    new_lines = after_lines - before_lines
-
-    cnt = 0
-    for line in new_lines:
-        line = line.decode("utf-8")
-        if (
-            line
-            and f"Processing SignatureRequest from user={tc.username}" in line
-            and (
-                f"principals:{tc.subteam}.ssh.staging,"
-                f"{tc.subteam}.ssh.root_everywhere, expiration:+1h, pubkey:"
-            )
-            in line
-        ):
-            cnt += 1
+    # Then poll for the expected number of new lines instead of sleeping for
+    # a fixed interval. KBFS usually flushes well before the old fixed 2.5
+    # second sleep. Only the suffix appended past the before offset gets
+    # scanned. When expecting zero lines we have to prove absence, so in that
+    # case all we can do is wait out a single confirmation window.
+    def check() -> int:
+        nonlocal after_size, new_data
+        after = read_file_bytes(filename)
+        after_size = len(after)
+        if after_size < before_size:
+            # The log was wiped (load_env does this between environments),
+            # so everything in it is new
+            new_data = after
+        else:
+            new_data = after[before_size:]
+        return _count_matching_audit_lines(tc, new_data.splitlines())
+
+    after_size = before_size
+    new_data = b""
+    if expected_number == 0:
+        time.sleep(1)
+        size = _file_size(filename)
+        if size is not None and size == before_size:
+            # Nothing was appended during the confirmation window, so there
+            # is no need to read the contents back at all
+            cnt = 0
+        else:
+            cnt = check()
+    else:
+        deadline = time.time() + 5
+        while True:
+            time.sleep(0.05)
+            cnt = check()
+            if cnt >= expected_number or time.time() >= deadline:
+                break
+    with _audit_log_lock:
+        _last_audit_sizes[filename] = after_size
 
     if cnt != expected_number:
-        assert (
-            False
-        ), f"Found {cnt} audit log entries, expected {expected_number}! \
-                New audit logs: {new_lines}"
+        assert False, f"Found {cnt} audit log entries, expected {expected_number}! \
+                New audit logs: {new_data.splitlines()}"
 
 
 def get_principals(certificateFilename: str) -> Set[str]:
@@ -1,6 +1,8 @@
 import hashlib
+import os
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 from lib import (
@@ -14,8 +16,15 @@ from lib import (
     simulate_two_teams,
 )
 
-defaultTeamName = TestConfig.getDefaultTestConfig().subteam
-test_env_1_log_filename = f"/keybase/team/" f"{defaultTeamName}.ssh.staging/ca.log"
+# "foo" is written to /tmp/foo and round-tripped through scp in
+# test_kssh_provision. Computed once here rather than on every assertion.
+fooHash = hashlib.sha1(b"foo").hexdigest().encode("utf-8")
+
+# Multiplexing options for the plain ssh calls in test_keybaseca_sign so
+# that repeated connections to the same host reuse one master connection.
+# The kssh invocations deliberately don't use these: reusing a connection
+# there would bypass the certificate provisioning that is under test.
+sshMuxOpts = "-o ControlMaster=auto -o ControlPath=/tmp/cm-%C -o ControlPersist=60"
 
 
 class TestMultiTeamStrictLogging:
@@ -27,133 +36,132 @@ class TestMultiTeamStrictLogging:
     def test_config(self):
         return TestConfig.getDefaultTestConfig()
 
+    @pytest.fixture(autouse=True, scope="class")
+    def log_filename(self, test_config):
+        # The audit log location configured in envFiles/test_env_1. Built
+        # inside a fixture rather than at import time so that collecting this
+        # module doesn't depend on the environment
+        return f"/keybase/team/{test_config.subteam}.ssh.staging/ca.log"
+
     def test_ping_pong_command(self, test_config):
         run_command(
-            f"keybase chat send --channel ssh-provision \
-            {test_config.subteam}.ssh 'ping @{test_config.bot_username}'"
+            [
+                "keybase",
+                "chat",
+                "send",
+                "--channel",
+                "ssh-provision",
+                f"{test_config.subteam}.ssh",
+                f"ping @{test_config.bot_username}",
+            ]
         )
         time.sleep(5)
-        recent_messages = run_command(f"keybase chat list-unread --since 1m")
-        assert (b"pong @%s" % test_config.username.encode("utf-8")) in recent_messages
+        recent_messages = run_command(
+            ["keybase", "chat", "list-unread", "--since", "1m"]
+        )
+        assert (b"pong @%s" % test_config.username_bytes) in recent_messages
 
-    def test_kssh_staging_user(self, test_config):
+    def test_kssh_staging_user(self, test_config, log_filename):
         # Test ksshing into staging as user
-        with outputs_audit_log(
-            test_config, filename=test_env_1_log_filename, expected_number=1
-        ):
+        with outputs_audit_log(test_config, filename=log_filename, expected_number=1):
             assert_contains_hash(
                 test_config.expected_hash,
-                run_command_with_agent(
-                    'bin/kssh -q -o StrictHostKeyChecking=no \
-                    user@sshd-staging "sha1sum /etc/unique" '
-                ),
+                run_command_with_agent('bin/kssh -q -o StrictHostKeyChecking=no \
+                    user@sshd-staging "sha1sum /etc/unique" '),
             )
 
-    def test_kssh_staging_root(self, test_config):
+    def test_kssh_staging_root(self, test_config, log_filename):
         # Test ksshing into staging as user
-        with outputs_audit_log(
-            test_config, filename=test_env_1_log_filename, expected_number=1
-        ):
+        with outputs_audit_log(test_config, filename=log_filename, expected_number=1):
             assert_contains_hash(
                 test_config.expected_hash,
-                run_command_with_agent(
-                    'bin/kssh -q -o StrictHostKeyChecking=no \
-                    root@sshd-staging "sha1sum /etc/unique" '
-                ),
+                run_command_with_agent('bin/kssh -q -o StrictHostKeyChecking=no \
+                    root@sshd-staging "sha1sum /etc/unique" '),
             )
 
-    def test_kssh_prod_root(self, test_config):
+    def test_kssh_prod_root(self, test_config, log_filename):
         # Test ksshing into prod as root
-        with outputs_audit_log(
-            test_config, filename=test_env_1_log_filename, expected_number=1
-        ):
+        with outputs_audit_log(test_config, filename=log_filename, expected_number=1):
             assert_contains_hash(
                 test_config.expected_hash,
-                run_command_with_agent(
-                    'bin/kssh -q -o StrictHostKeyChecking=no \
-                    root@sshd-prod "sha1sum /etc/unique" '
-                ),
+                run_command_with_agent('bin/kssh -q -o StrictHostKeyChecking=no \
+                    root@sshd-prod "sha1sum /etc/unique" '),
             )
 
-    def test_kssh_reject_prod_user(self, test_config):
+    def test_kssh_reject_prod_user(self, test_config, log_filename):
         # Test that we can't kssh into prod as user since we aren't in the
         # correct team for that
-        with outputs_audit_log(
-            test_config, filename=test_env_1_log_filename, expected_number=1
-        ):
+        with outputs_audit_log(test_config, filename=log_filename, expected_number=1):
             try:
-                run_command_with_agent(
-                    'bin/kssh -o StrictHostKeyChecking=no \
-                    user@sshd-prod "sha1sum /etc/unique" 2>&1 '
-                )
+                run_command_with_agent('bin/kssh -o StrictHostKeyChecking=no \
+                    user@sshd-prod "sha1sum /etc/unique" 2>&1 ')
                 assert False
             except subprocess.CalledProcessError as e:
                 assert b"Permission denied" in e.output
                 assert test_config.expected_hash not in e.output
 
-    def test_kssh_reuse(self, test_config):
+    def test_kssh_reuse(self, test_config, log_filename):
         # Test that kssh reuses unexpired keys
-        with outputs_audit_log(
-            test_config, filename=test_env_1_log_filename, expected_number=1
-        ):
+        with outputs_audit_log(test_config, filename=log_filename, expected_number=1):
             assert_contains_hash(
                 test_config.expected_hash,
-                run_command_with_agent(
-                    'bin/kssh -q -o StrictHostKeyChecking=no \
-                    root@sshd-prod "sha1sum /etc/unique" '
-                ),
+                run_command_with_agent('bin/kssh -q -o StrictHostKeyChecking=no \
+                    root@sshd-prod "sha1sum /etc/unique" '),
             )
             start = time.time()
             assert_contains_hash(
                 test_config.expected_hash,
-                run_command_with_agent(
-                    'bin/kssh -q -o StrictHostKeyChecking=no \
-                    root@sshd-prod "sha1sum /etc/unique" '
-                ),
+                run_command_with_agent('bin/kssh -q -o StrictHostKeyChecking=no \
+                    root@sshd-prod "sha1sum /etc/unique" '),
             )
             elapsed = time.time() - start
             assert elapsed < 0.5
 
-    def test_kssh_regenerate_expired_keys(self, test_config):
+    def test_kssh_regenerate_expired_keys(self, test_config, log_filename):
         # Test that kssh reprovisions a key when the stored keys are expired
-        with outputs_audit_log(
-            test_config, filename=test_env_1_log_filename, expected_number=1
-        ):
-            run_command_with_agent(
-                "mv ~/tests/testFiles/expired ~/.ssh/keybase-signed-key-- && \
-                mv ~/tests/testFiles/expired.pub \
-                ~/.ssh/keybase-signed-key--.pub && \
-                mv ~/tests/testFiles/expired-cert.pub \
-                ~/.ssh/keybase-signed-key---cert.pub"
-            )
+        with outputs_audit_log(test_config, filename=log_filename, expected_number=1):
+            # Move the expired key into place in-process rather than spawning
+            # a shell (plus an agent) just to run three mv commands
+            for src, dst in [
+                ("~/tests/testFiles/expired", "~/.ssh/keybase-signed-key--"),
+                ("~/tests/testFiles/expired.pub", "~/.ssh/keybase-signed-key--.pub"),
+                (
+                    "~/tests/testFiles/expired-cert.pub",
+                    "~/.ssh/keybase-signed-key---cert.pub",
+                ),
+            ]:
+                os.replace(os.path.expanduser(src), os.path.expanduser(dst))
             assert_contains_hash(
                 test_config.expected_hash,
-                run_command_with_agent(
-                    'bin/kssh -q -o StrictHostKeyChecking=no \
-                    root@sshd-prod "sha1sum /etc/unique" '
-                ),
+                run_command_with_agent('bin/kssh -q -o StrictHostKeyChecking=no \
+                    root@sshd-prod "sha1sum /etc/unique" '),
             )
 
-    def test_kssh_provision(self, test_config):
-        # Test the `kssh --provision` flag
-        # we have to run all of the below commands in one run_command call so
-        # that environment variables are shared so ssh-agent can work
-        with outputs_audit_log(
-            test_config, filename=test_env_1_log_filename, expected_number=1
-        ):
-            output = run_command_with_agent(
-                """
-            bin/kssh --provision
-            ssh -q -o StrictHostKeyChecking=no \
-                    root@sshd-prod "sha1sum /etc/unique"
-            echo -n foo > /tmp/foo
-            scp /tmp/foo root@sshd-prod:/tmp/foo
-            ssh -q -o StrictHostKeyChecking=no \
-                    root@sshd-prod "sha1sum /tmp/foo"
-            """
-            )
-            assert_contains_hash(test_config.expected_hash, output)
-            assert hashlib.sha1(b"foo").hexdigest().encode("utf-8") in output
+    def test_kssh_provision(self, test_config, log_filename):
+        # Test the `kssh --provision` flag. The commands all share the one
+        # ssh-agent that run_command_with_agent talks to, so they no longer
+        # need to run inside a single shell
+        with outputs_audit_log(test_config, filename=log_filename, expected_number=1):
+            run_command_with_agent("bin/kssh --provision")
+
+            def check_unique() -> bytes:
+                return run_command_with_agent('ssh -q -o StrictHostKeyChecking=no \
+                    root@sshd-prod "sha1sum /etc/unique"')
+
+            def roundtrip_foo() -> bytes:
+                with open("/tmp/foo", "wb") as f:
+                    f.write(b"foo")
+                run_command_with_agent("scp /tmp/foo root@sshd-prod:/tmp/foo")
+                return run_command_with_agent('ssh -q -o StrictHostKeyChecking=no \
+                    root@sshd-prod "sha1sum /tmp/foo"')
+
+            # The two checks only depend on the provisioned key, not on each
+            # other, so run them concurrently
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                unique_future = executor.submit(check_unique)
+                foo_future = executor.submit(roundtrip_foo)
+                assert_contains_hash(test_config.expected_hash, unique_future.result())
+                assert fooHash in foo_future.result()
         assert get_principals("~/.ssh/keybase-signed-key---cert.pub") == set(
             [
                 test_config.subteam + ".ssh.staging",
@@ -161,11 +169,11 @@ class TestMultiTeamStrictLogging:
             ]
         )
 
-    def test_kssh_errors_on_two_bots(self, test_config):
+    def test_kssh_errors_on_two_bots(self, test_config, log_filename):
         # Test that kssh does not run if there are multiple bots, no kssh
         # config, and no --bot flag
         with simulate_two_teams(test_config), outputs_audit_log(
-            test_config, filename=test_env_1_log_filename, expected_number=0
+            test_config, filename=log_filename, expected_number=0
         ):
             try:
                 run_command_with_agent("bin/kssh root@sshd-prod")
@@ -173,10 +181,10 @@ class TestMultiTeamStrictLogging:
             except subprocess.CalledProcessError as e:
                 assert b"Found 2 configs" in e.output
 
-    def test_kssh_bot_flag(self, test_config):
+    def test_kssh_bot_flag(self, test_config, log_filename):
         # Test that kssh works with the --bot flag
         with simulate_two_teams(test_config), outputs_audit_log(
-            test_config, filename=test_env_1_log_filename, expected_number=1
+            test_config, filename=log_filename, expected_number=1
         ):
             assert_contains_hash(
                 test_config.expected_hash,
@@ -187,26 +195,24 @@ class TestMultiTeamStrictLogging:
                 ),
             )
 
-    def test_kssh_set_default_bot(self, test_config):
+    def test_kssh_set_default_bot(self, test_config, log_filename):
         # Test that kssh works with the --set-default-bot flag
         with simulate_two_teams(test_config), outputs_audit_log(
-            test_config, filename=test_env_1_log_filename, expected_number=1
+            test_config, filename=log_filename, expected_number=1
         ):
             run_command_with_agent(
                 f"bin/kssh --set-default-bot {test_config.bot_username}"
             )
             assert_contains_hash(
                 test_config.expected_hash,
-                run_command_with_agent(
-                    "bin/kssh -q -o StrictHostKeyChecking=no \
-                    root@sshd-prod 'sha1sum /etc/unique'"
-                ),
+                run_command_with_agent("bin/kssh -q -o StrictHostKeyChecking=no \
+                    root@sshd-prod 'sha1sum /etc/unique'"),
             )
 
-    def test_kssh_override_default_bot(self, test_config):
+    def test_kssh_override_default_bot(self, test_config, log_filename):
         # Test that the --bot flag overrides the local config file
         with simulate_two_teams(test_config), outputs_audit_log(
-            test_config, filename=test_env_1_log_filename, expected_number=1
+            test_config, filename=log_filename, expected_number=1
         ):
             run_command_with_agent(f"bin/kssh --set-default-bot otherbotname")
             assert_contains_hash(
@@ -218,10 +224,10 @@ class TestMultiTeamStrictLogging:
                 ),
             )
 
-    def test_kssh_clear_default_bot(self, test_config):
+    def test_kssh_clear_default_bot(self, test_config, log_filename):
         # Test that kssh --clear-default-bot clears the default bot
         with simulate_two_teams(test_config), outputs_audit_log(
-            test_config, filename=test_env_1_log_filename, expected_number=0
+            test_config, filename=log_filename, expected_number=0
         ):
             run_command_with_agent(
                 f"bin/kssh --set-default-bot {test_config.bot_username}"
@@ -237,8 +243,8 @@ class TestMultiTeamStrictLogging:
     def test_keybaseca_backup(self):
         # Test the keybaseca backup command by reading and verifying the
         # private key stored in /shared/cakey.backup
-        run_command("mkdir -p /tmp/ssh/")
-        run_command("chown -R keybase:keybase /tmp/ssh/")
+        run_command(["mkdir", "-p", "/tmp/ssh/"])
+        run_command(["chown", "-R", "keybase:keybase", "/tmp/ssh/"])
         with open("/shared/cakey.backup") as f:
             keyLines = []
             add = False
@@ -252,8 +258,8 @@ class TestMultiTeamStrictLogging:
         key = "\n".join(keyLines) + "\n"
         with open("/tmp/ssh/cakey", "w+") as f:
             f.write(key)
-        run_command("chmod 0600 /tmp/ssh/cakey")
-        output = run_command("ssh-keygen -y -e -f /tmp/ssh/cakey")
+        run_command(["chmod", "0600", "/tmp/ssh/cakey"])
+        output = run_command(["ssh-keygen", "-y", "-e", "-f", "/tmp/ssh/cakey"])
         assert b"BEGIN SSH2 PUBLIC KEY" in output
 
     def test_keybaseca_sign(self, test_config):
@@ -265,28 +271,28 @@ class TestMultiTeamStrictLogging:
         assert_contains_hash(
             test_config.expected_hash,
             run_command(
-                f"ssh -q -o StrictHostKeyChecking=no -i "
+                f"ssh -q -o StrictHostKeyChecking=no {sshMuxOpts} -i "
                 f"/shared/userkey user@sshd-prod 'sha1sum /etc/unique'"
             ),
         )
         assert_contains_hash(
             test_config.expected_hash,
             run_command(
-                f"ssh -q -o StrictHostKeyChecking=no -i "
+                f"ssh -q -o StrictHostKeyChecking=no {sshMuxOpts} -i "
                 f"/shared/userkey root@sshd-prod 'sha1sum /etc/unique'"
             ),
         )
         assert_contains_hash(
             test_config.expected_hash,
             run_command(
-                f"ssh -q -o StrictHostKeyChecking=no -i "
+                f"ssh -q -o StrictHostKeyChecking=no {sshMuxOpts} -i "
                 f"/shared/userkey user@sshd-staging 'sha1sum /etc/unique'"
             ),
         )
         assert_contains_hash(
             test_config.expected_hash,
             run_command(
-                f"ssh -q -o StrictHostKeyChecking=no -i "
+                f"ssh -q -o StrictHostKeyChecking=no {sshMuxOpts} -i "
                 f"/shared/userkey root@sshd-prod 'sha1sum /etc/unique'"
             ),
         )
@@ -300,10 +306,8 @@ class TestMultiTeamStrictLogging:
         # A normal SSH connection
         assert_contains_hash(
             test_config.expected_hash,
-            run_command_with_agent(
-                "bin/kssh -q -o StrictHostKeyChecking=no \
-                sshd-prod 'sha1sum /etc/unique'"
-            ),
+            run_command_with_agent("bin/kssh -q -o StrictHostKeyChecking=no \
+                sshd-prod 'sha1sum /etc/unique'"),
         )
         assert b"root" in run_command_with_agent(
             "bin/kssh -q -o StrictHostKeyChecking=no sshd-prod 'whoami'"
@@ -311,10 +315,8 @@ class TestMultiTeamStrictLogging:
         # A proxy jump (relies on the ssh agent)
         assert_contains_hash(
             test_config.expected_hash,
-            run_command_with_agent(
-                "bin/kssh -q -o StrictHostKeyChecking=no \
-                -J sshd-staging sshd-prod 'sha1sum /etc/unique'"
-            ),
+            run_command_with_agent("bin/kssh -q -o StrictHostKeyChecking=no \
+                -J sshd-staging sshd-prod 'sha1sum /etc/unique'"),
         )
         # Reset the default user
         run_command_with_agent("bin/kssh --clear-default-user")
@@ -324,9 +326,9 @@ class TestMultiTeamStrictLogging:
         # running kssh. This isn't a perfect test but it is enough to smoketest
         # it
         run_command("echo '#!/bin/bash' | sudo tee /usr/local/bin/keybase")
-        run_command("sudo chmod +x /usr/local/bin/keybase")
+        run_command(["sudo", "chmod", "+x", "/usr/local/bin/keybase"])
         try:
-            run_command("bin/kssh --set-keybase-binary /usr/bin/keybase")
+            run_command(["bin/kssh", "--set-keybase-binary", "/usr/bin/keybase"])
             assert_contains_hash(
                 test_config.expected_hash,
                 run_command_with_agent(
@@ -334,6 +336,6 @@ class TestMultiTeamStrictLogging:
                     "user@sshd-staging 'sha1sum /etc/unique'"
                 ),
             )
-            run_command("bin/kssh --set-keybase-binary ''")
+            run_command(["bin/kssh", "--set-keybase-binary", ""])
         finally:
-            run_command("sudo rm /usr/local/bin/keybase")
+            run_command(["sudo", "rm", "/usr/local/bin/keybase"])